@@ -1,39 +1,103 @@
 import os
-import shutil
-import hashlib
+import re
+import asyncio
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 import time
-import uuid
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile, Request
+import secrets
+from blake3 import blake3
+from fastapi import BackgroundTasks, Body, Depends, FastAPI, File, Form, HTTPException, Query, UploadFile, Request
 from fastapi.responses import FileResponse, RedirectResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import Column, Integer, String, Float, DateTime, create_engine, or_
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index, create_engine, event, inspect, or_, text, update
+from sqlalchemy import delete as sql_delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
 
 
 # === CONFIG ===
 UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Content hashes are BLAKE3 with this prefix; legacy SHA-256 uploads are re-hashed at startup
+HASH_PREFIX = "b3_"
+# Content-addressed store: one object per hash under by-hash/ab/cd/, hardlinked once per
+# UserFile row so the filesystem link count tracks how many rows still use the bytes
+OBJECT_FOLDER = os.path.join(UPLOAD_FOLDER, "by-hash")
+LINK_FOLDER = os.path.join(UPLOAD_FOLDER, "files")
+os.makedirs(OBJECT_FOLDER, exist_ok=True)
+os.makedirs(LINK_FOLDER, exist_ok=True)
 USER_QUOTA_BYTES = 10 * 1024 * 1024  # 10 MB limit
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB read/write chunks for uploads
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB read chunks for downloads
+DASHBOARD_PAGE_SIZE = 100  # files per dashboard page
+DASHBOARD_MAX_PAGE = 10000  # keeps the OFFSET well inside SQLite's integer range
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))  # work factor for new password hashes
 SECRET_KEY = "change_this_to_a_strong_random_string_in_production!!!"
-
-# Rate limiting
-last_upload_time = {}
+JINJA_CACHE_FOLDER = ".jinja_cache"
+os.makedirs(JINJA_CACHE_FOLDER, exist_ok=True)
+
+# Rate limiting: monotonic timestamps of uploads still inside the window, oldest first
+UPLOAD_RATE_LIMIT_SECONDS = 0.5
+RATE_LIMIT_MAX_USERS = 10000
+last_upload_time = OrderedDict()
+
+class PageGZipMiddleware(GZipMiddleware):
+    """GZip pages and API responses, but stream stored files untouched"""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(("/download/", "/public/")):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    autoescape=True,
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_FOLDER),
+))
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+app.add_middleware(PageGZipMiddleware, minimum_size=512)
+# Shared pool for hashing/writing uploads; blake3 releases the GIL so files hash in parallel
+app.state.hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
 
 # === DATABASE ===
 Base = declarative_base()
-engine = create_engine("sqlite:///vinnodrive.db", connect_args={"check_same_thread": False})
+# Sized to match FastAPI's 40-thread pool so threadpool routes never queue on a connection
+engine = create_engine(
+    "sqlite:///vinnodrive.db",
+    connect_args={"check_same_thread": False},
+    pool_size=20,
+    max_overflow=20,
+    pool_timeout=30,
+)
 SessionLocal = sessionmaker(bind=engine)
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB memory-mapped I/O
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
@@ -44,7 +108,6 @@ class UserFile(Base):
     __tablename__ = "user_files"
     id = Column(Integer, primary_key=True)
     filename = Column(String)
-    filepath = Column(String)
     filehash = Column(String)
     username = Column(String)
     is_reference = Column(Integer, default=0)
@@ -55,6 +118,26 @@ class UserFile(Base):
     share_token = Column(String, unique=True, nullable=True)
     download_count = Column(Integer, default=0)
 
+    __table_args__ = (
+        Index("ix_userfile_user_hash", "username", "filehash", "is_reference"),
+        Index("ix_userfile_user_folder", "username", "folder"),
+        # One original per (user, content); duplicates are stored as reference rows
+        Index(
+            "ux_userfile_original_hash", "username", "filehash",
+            unique=True,
+            sqlite_where=text("is_reference = 0 AND filehash != 'folder_marker'"),
+        ),
+        # Row ids name the files/<id> hardlinks, so a deleted row's id must never come back
+        {"sqlite_autoincrement": True},
+    )
+
+class UserStats(Base):
+    """Running storage totals per user, kept in step with user_files on every insert/delete"""
+    __tablename__ = "user_stats"
+    username = Column(String, primary_key=True)
+    actual_bytes = Column(Float, default=0)  # originals
+    saved_bytes = Column(Float, default=0)  # duplicate references
+
 class SharedFile(Base):
     __tablename__ = "shared_files"
     id = Column(Integer, primary_key=True)
@@ -62,61 +145,269 @@ class SharedFile(Base):
     shared_with = Column(String)
     shared_by = Column(String)
 
-Base.metadata.create_all(bind=engine)
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# === HELPERS ===
-def calculate_hash(file_path: str) -> str:
-    sha = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha.update(chunk)
-    return sha.hexdigest()
-
-def get_actual_storage(username: str) -> int:
+    __table_args__ = (
+        Index("ix_shared_with_file", "shared_with", "file_id"),
+        Index("ix_shared_file_with", "file_id", "shared_with"),
+    )
+
+@contextmanager
+def startup_lock():
+    """Serialize schema and storage migrations across uvicorn worker processes"""
+    with open(os.path.join(UPLOAD_FOLDER, ".startup.lock"), "w") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            # LK_LOCK gives up after ~10 s of retries; keep waiting for the other worker
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+# create_all skips indexes on tables that already exist, so add any missing ones
+# and refresh planner statistics for databases created before they were defined
+with startup_lock(), engine.begin() as conn:
+    had_user_stats = inspect(conn).has_table("user_stats")
+    Base.metadata.create_all(bind=conn)
+    if not had_user_stats:
+        conn.exec_driver_sql(
+            "INSERT INTO user_stats (username, actual_bytes, saved_bytes) "
+            "SELECT username, "
+            "COALESCE(SUM(CASE WHEN is_reference = 0 THEN size END), 0), "
+            "COALESCE(SUM(CASE WHEN is_reference = 1 THEN size END), 0) "
+            "FROM user_files GROUP BY username"
+        )
+    # filepath is derived from the row now; drop the legacy column (SQLite 3.35+)
+    if "filepath" in {c["name"] for c in inspect(conn).get_columns("user_files")}:
+        conn.exec_driver_sql("ALTER TABLE user_files DROP COLUMN filepath")
+    # Tables created without AUTOINCREMENT hand out a deleted max id again; rebuild them
+    user_files_sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'user_files'"
+    ).scalar()
+    if "AUTOINCREMENT" not in user_files_sql.upper():
+        columns = ", ".join(c.name for c in UserFile.__table__.columns)
+        conn.exec_driver_sql("ALTER TABLE user_files RENAME TO user_files_old")
+        UserFile.__table__.create(conn)
+        conn.exec_driver_sql(f"INSERT INTO user_files ({columns}) SELECT {columns} FROM user_files_old")
+        conn.exec_driver_sql("DROP TABLE user_files_old")
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    conn.exec_driver_sql("PRAGMA analysis_limit=1000")
+    conn.exec_driver_sql("ANALYZE")
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+def get_db():
+    """Yield one session per request, closed once the response is done"""
     db = SessionLocal()
     try:
-        return sum(f.size for f in db.query(UserFile).filter(
-            UserFile.username == username,
-            UserFile.is_reference == 0
-        ).all())
+        yield db
     finally:
         db.close()
 
-def get_user_space_saved(username: str) -> int:
-    db = SessionLocal()
+# === HELPERS ===
+def discard_file(path: str):
+    """Unlink path if it is there; one syscall instead of an exists() probe plus remove()"""
     try:
-        return sum(f.size for f in db.query(UserFile).filter(
-            UserFile.username == username,
-            UserFile.is_reference == 1
-        ).all())
-    finally:
-        db.close()
-
-def get_original_uploaded(username: str) -> int:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def object_path(filehash: str) -> str:
+    """Objects are sharded by the first two digest bytes to keep directories small"""
+    digest = filehash.removeprefix(HASH_PREFIX)
+    return os.path.join(OBJECT_FOLDER, digest[:2], digest[2:4], filehash)
+
+def publish_object(src: str, filehash: str) -> bool:
+    """Hardlink src into the store; False if the object already exists"""
+    obj = object_path(filehash)
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    # Never replace an existing object: rows elsewhere hold hardlinks to its inode
+    try:
+        os.link(src, obj)
+    except FileExistsError:
+        return False
+    return True
+
+def blob_path(file_id: int, filehash: str) -> str:
+    """Location of a UserFile row's hardlink on disk; folder markers have no blob"""
+    if filehash == "folder_marker":
+        return ""
+    return os.path.join(LINK_FOLDER, str(file_id))
+
+def link_blob(file_id: int, filehash: str) -> str:
+    path = blob_path(file_id, filehash)
+    os.link(object_path(filehash), path)
+    return path
+
+def release_blob(file_id: int, filehash: str):
+    """Drop a row's hardlink and the object itself once no other row links to it"""
+    path = blob_path(file_id, filehash)
+    if not path:
+        return
+    try:
+        os.unlink(path)
+        obj = object_path(filehash)
+        if os.stat(obj).st_nlink == 1:
+            os.unlink(obj)
+    except OSError:
+        # Runs as a background task; a failed unlink must not stop the tasks queued after it
+        pass
+
+def link_upload(file_id: int, filehash: str, temp_path: str, data: bytes | None) -> list[str]:
+    """Hardlink a new row to its object, publishing the upload's own bytes if the object is missing.
+
+    Runs while the upload's temp file still exists, so an object that a concurrent
+    release_blob removes in the meantime is simply published again. Returns the paths created.
+    """
+    try:
+        return [link_blob(file_id, filehash)]
+    except FileNotFoundError:
+        pass  # content not stored yet, or its last row was just deleted
+    if data is not None:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+    created = [object_path(filehash)] if publish_object(temp_path, filehash) else []
+    created.append(link_blob(file_id, filehash))
+    return created
+
+LEGACY_BLOB_RE = re.compile(r"(?P<username>.+)_(?P<digest>[0-9a-f]{64})")
+
+def migrate_legacy_blobs():
+    """Re-key uploads stored as uploads/{username}_{sha256} by BLAKE3 and move them into the store.
+
+    Rows pointing at a legacy blob take its b3_ hash, so new uploads of the same
+    content keep deduplicating against them.
+    """
+    legacy = [
+        (entry, match) for entry in os.scandir(UPLOAD_FOLDER)
+        if entry.is_file() and (match := LEGACY_BLOB_RE.fullmatch(entry.name))
+    ]
+    if not legacy:
+        return
     db = SessionLocal()
     try:
-        return sum(f.size for f in db.query(UserFile).filter(UserFile.username == username).all())
+        for entry, match in legacy:
+            hasher = blake3(max_threads=blake3.AUTO)
+            hasher.update_mmap(entry.path)
+            file_hash = HASH_PREFIX + hasher.hexdigest()
+            publish_object(entry.path, file_hash)
+            rows = db.execute(
+                update(UserFile)
+                .where(UserFile.username == match["username"], UserFile.filehash == match["digest"])
+                .values(filehash=file_hash)
+                .returning(UserFile.id)
+                .execution_options(synchronize_session=False)
+            ).all()
+            for row in rows:
+                try:
+                    link_blob(row.id, file_hash)
+                except FileExistsError:
+                    pass  # linked by an earlier run that stopped before committing
+        db.commit()
     finally:
         db.close()
+    for entry, _ in legacy:
+        os.remove(entry.path)
+
+with startup_lock():
+    migrate_legacy_blobs()
+
+def store_upload(src, temp_path: str) -> tuple[str, int, bytes | None]:
+    """Copy an upload stream to temp_path, returning its content hash and size in one pass.
+
+    Uploads Starlette still holds in memory are hashed in place and returned as bytes
+    instead; save_uploads writes them out only if they turn out to be new content.
+    """
+    if not getattr(src, "_rolled", True):
+        data = src.read()
+        return HASH_PREFIX + blake3(data).hexdigest(), len(data), data
+    # Rolled uploads are over 1 MB, so each chunk is large enough to split across cores
+    hasher = blake3(max_threads=blake3.AUTO)
+    size = 0
+    with open(temp_path, "wb", buffering=UPLOAD_CHUNK_SIZE) as f:
+        while chunk := src.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return HASH_PREFIX + hasher.hexdigest(), size, None
+
+def get_user_stats(db: Session, username: str):
+    """Return (actual_used, saved_space, original_uploaded) for a user from their user_stats row"""
+    return db.query(
+        UserStats.actual_bytes.label("actual_used"),
+        UserStats.saved_bytes.label("saved_space"),
+        (UserStats.actual_bytes + UserStats.saved_bytes).label("original_uploaded"),
+    ).filter(UserStats.username == username).first() or (0, 0, 0)
+
+def add_usage(db: Session, username: str, actual: float = 0, saved: float = 0):
+    """Apply upload/delete deltas to the user's totals inside the caller's transaction"""
+    stmt = sqlite_insert(UserStats).values(username=username, actual_bytes=actual, saved_bytes=saved)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[UserStats.username],
+        set_={
+            "actual_bytes": UserStats.actual_bytes + stmt.excluded.actual_bytes,
+            "saved_bytes": UserStats.saved_bytes + stmt.excluded.saved_bytes,
+        },
+    ))
+
+def charge_quota(db: Session, username: str, size: int) -> bool:
+    """Add size to the user's stored bytes only if it fits the quota; the check and the charge are one UPDATE"""
+    return db.execute(
+        update(UserStats).where(
+            UserStats.username == username,
+            UserStats.actual_bytes + size <= USER_QUOTA_BYTES
+        ).values(actual_bytes=UserStats.actual_bytes + size).execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+# Extension -> preview type; built in reverse so the first listed type wins and .ogg previews as video
+PREVIEW_TYPES = {
+    ext: preview_type
+    for preview_type, extensions in reversed((
+        ('image', ('jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg')),
+        ('pdf', ('pdf',)),
+        ('text', ('txt', 'md', 'json', 'xml', 'csv', 'log')),
+        ('video', ('mp4', 'webm', 'ogg', 'mov')),
+        ('audio', ('mp3', 'wav', 'ogg', 'flac')),
+    ))
+    for ext in extensions
+}
+
+MULTI_SLASH_RE = re.compile(r"/+")
+HEX_DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+# Client-supplied BLAKE3 digest of a single-file upload
+CONTENT_HASH_HEADER = "x-content-blake3"
 
 def normalize_folder_path(folder: str) -> str:
     """Normalize folder path to always have leading and trailing slashes"""
     if not folder:
         return "/"
-    folder = folder.strip().replace("\\", "/")
-    while "//" in folder:
-        folder = folder.replace("//", "/")
+    folder = MULTI_SLASH_RE.sub("/", folder.strip().replace("\\", "/"))
     if not folder.startswith("/"):
         folder = "/" + folder
     if not folder.endswith("/"):
         folder = folder + "/"
     return folder
 
+class DownloadResponse(FileResponse):
+    """FileResponse that streams stored files in larger chunks"""
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+
 
 
 # === ROUTES ===
+# Routes that only touch the (synchronous) database are plain `def`, so FastAPI runs them
+# in its threadpool instead of blocking the event loop
 @app.get("/")
 async def root(request: Request):
     if request.session.get("username"):
@@ -137,279 +428,375 @@ async def signup_page(request: Request):
     return templates.TemplateResponse("signup.html", {"request": request})
 
 @app.post("/signup")
-async def signup(request: Request, username: str = Form(...), password: str = Form(...)):
-    db = SessionLocal()
-    try:
-        if db.query(User).filter(User.username == username).first():
-            return templates.TemplateResponse("signup.html", {"request": request, "error": "Username already taken"})
-        db.add(User(username=username, hashed_password=pwd_context.hash(password)))
-        db.commit()
-        return RedirectResponse("/", status_code=303)
-    finally:
-        db.close()
+def signup(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+    if db.query(User).filter(User.username == username).first():
+        return templates.TemplateResponse("signup.html", {"request": request, "error": "Username already taken"})
+    db.add(User(username=username, hashed_password=pwd_context.hash(password)))
+    db.commit()
+    return RedirectResponse("/", status_code=303)
 
 @app.post("/login")
-async def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.username == username).first()
-        if not user or not pwd_context.verify(password, user.hashed_password):
-            return templates.TemplateResponse("login.html", {"request": request, "error": "Wrong username or password"})
-        request.session["username"] = username
-        return RedirectResponse("/dashboard", status_code=303)
-    finally:
-        db.close()
+def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+    user = db.query(User).filter(User.username == username).first()
+    if not user:
+        # Burn a verify's worth of time so unknown usernames aren't distinguishable by latency
+        pwd_context.dummy_verify()
+    if not user or not pwd_context.verify(password, user.hashed_password):
+        return templates.TemplateResponse("login.html", {"request": request, "error": "Wrong username or password"})
+    request.session["username"] = username
+    return RedirectResponse("/dashboard", status_code=303)
 
 @app.get("/dashboard")
-async def dashboard(request: Request):
+def dashboard(
+    request: Request,
+    page: int = Query(1, ge=1, le=DASHBOARD_MAX_PAGE),
+    shared_page: int = Query(1, ge=1, le=DASHBOARD_MAX_PAGE),
+    folder: str | None = None,
+    db: Session = Depends(get_db)
+):
     username = request.session.get("username")
     if not username: 
         return RedirectResponse("/")
+    offset = (page - 1) * DASHBOARD_PAGE_SIZE
     
-    db = SessionLocal()
-    try:
-        own_files = db.query(UserFile).filter(UserFile.username == username).all()
-        
-        shared_with_me_entries = db.query(SharedFile).filter(SharedFile.shared_with == username).all()
-        shared_with_me_ids = [s.file_id for s in shared_with_me_entries]
-        shared_with_me_files = db.query(UserFile).filter(UserFile.id.in_(shared_with_me_ids)).all() if shared_with_me_ids else []
-        
-        shared_by_me = []
-        for file in own_files:
-            recipients = db.query(SharedFile).filter(SharedFile.file_id == file.id).all()
-            if recipients:
-                shared_by_me.append({
-                    'file': file,
-                    'shared_with': [r.shared_with for r in recipients]
-                })
-        
-        actual_used = get_actual_storage(username)
-        original_uploaded = get_original_uploaded(username)
-        saved_space = get_user_space_saved(username)
-        savings_percent = (saved_space / original_uploaded * 100) if original_uploaded > 0 else 0
-    finally:
-        db.close()
+    # Folder markers feed the folder picker, so they are listed in full on every page
+    folder_markers = db.query(UserFile.filename, UserFile.folder).filter(
+        UserFile.username == username,
+        UserFile.filehash == "folder_marker"
+    ).all()
+    
+    # Plain rows with only the columns the template renders; each list pages on its own and
+    # fetches one extra row to learn whether a next page exists without a COUNT
+    own_query = db.query(
+        UserFile.id, UserFile.filename, UserFile.size, UserFile.folder, UserFile.upload_date,
+        UserFile.is_reference, UserFile.is_public, UserFile.share_token, UserFile.download_count
+    ).filter(
+        UserFile.username == username,
+        UserFile.filehash != "folder_marker"
+    )
+    if folder:
+        # Narrow to one folder; served by ix_userfile_user_folder
+        folder = normalize_folder_path(folder)
+        own_query = own_query.filter(UserFile.folder == folder)
+    own_files = own_query.order_by(UserFile.id.desc()).offset(offset).limit(DASHBOARD_PAGE_SIZE + 1).all()
+    
+    shared_with_me_files = db.query(
+        UserFile.id, UserFile.filename, UserFile.size, UserFile.username
+    ).join(
+        SharedFile, SharedFile.file_id == UserFile.id
+    ).filter(SharedFile.shared_with == username).order_by(
+        UserFile.id.desc()
+    ).offset((shared_page - 1) * DASHBOARD_PAGE_SIZE).limit(DASHBOARD_PAGE_SIZE + 1).all()
+    
+    has_next = len(own_files) > DASHBOARD_PAGE_SIZE
+    shared_has_next = len(shared_with_me_files) > DASHBOARD_PAGE_SIZE
+    own_files = own_files[:DASHBOARD_PAGE_SIZE]
+    shared_with_me_files = shared_with_me_files[:DASHBOARD_PAGE_SIZE]
+    
+    # The stat card counts every file the user owns, not just this page or folder
+    total_files = db.query(UserFile.id).filter(
+        UserFile.username == username,
+        UserFile.filehash != "folder_marker"
+    ).count()
+    
+    # Every file the user has shared with its recipients, in one JOIN independent of the page
+    shared_by_me = {}
+    for row in db.query(
+        UserFile.id, UserFile.filename, UserFile.size, UserFile.upload_date, SharedFile.shared_with
+    ).join(
+        SharedFile, SharedFile.file_id == UserFile.id
+    ).filter(UserFile.username == username).order_by(UserFile.id.desc()):
+        shared_by_me.setdefault(row.id, {'file': row, 'shared_with': []})['shared_with'].append(row.shared_with)
+    
+    actual_used, saved_space, original_uploaded = get_user_stats(db, username)
+    savings_percent = (saved_space / original_uploaded * 100) if original_uploaded > 0 else 0
 
     return templates.TemplateResponse("dashboard.html", {
         "request": request,
-        "files": own_files,
+        "files": folder_markers + own_files,
         "shared_with_me_files": shared_with_me_files,
-        "shared_by_me": shared_by_me,
+        "shared_by_me": list(shared_by_me.values()),
+        "total_files": total_files,
         "username": username,
         "actual_used": actual_used,
         "original_uploaded": original_uploaded,
         "saved_space": saved_space,
         "savings_percent": savings_percent,
         "quota_bytes": USER_QUOTA_BYTES,
-        "quota_mb": 10
+        "quota_mb": 10,
+        "page": page,
+        "has_next": has_next,
+        "shared_page": shared_page,
+        "shared_has_next": shared_has_next,
+        "current_folder": folder
     })
 
-@app.post("/upload")
-async def upload(request: Request, folder: str = Form("/"), files: list[UploadFile] = File(...)):
-    username = request.session.get("username")
-    if not username:
-        return JSONResponse({"results": [], "error": "Session expired. Please login again."}, status_code=401)
-
-    if not files or all(not f.filename for f in files):
-        return JSONResponse({"results": [], "error": "No files selected"}, status_code=400)
-
-    now = time.time()
-    if username in last_upload_time and now - last_upload_time[username] < 0.5:
-        return JSONResponse({"results": [], "error": "Too many uploads! Wait a second."}, status_code=429)
-    last_upload_time[username] = now
-
-    folder = normalize_folder_path(folder)
-
-    current_used = get_actual_storage(username)
-    new_original_size = 0
-    temp_files = []
-
+def record_claimed_duplicate(db: Session, username: str, folder: str, filename: str, claimed_hash: str):
+    """Add a reference row for a client-supplied digest that matches one of the user's originals"""
+    original = db.query(UserFile.size).filter(
+        UserFile.filehash == claimed_hash,
+        UserFile.username == username,
+        UserFile.is_reference == 0
+    ).first()
+    if not original:
+        return None
+    entry = UserFile(
+        filename=filename,
+        filehash=claimed_hash,
+        username=username,
+        is_reference=1,
+        size=original.size,
+        folder=folder,
+        is_public=0,
+        download_count=0
+    )
+    db.add(entry)
+    db.flush()
+    add_usage(db, username, saved=original.size)
+    link_blob(entry.id, claimed_hash)
+    db.commit()
+    return [{"filename": filename, "message": "Duplicate (you already uploaded this file)"}]
+
+def save_uploads(db: Session, username: str, folder: str, temp_files: list) -> JSONResponse:
+    """Quota-check hashed temp files and move them into the store; runs in the threadpool"""
+    results = []
+    stored_paths = []
+    saved_added = 0
     try:
-        for file in files:
-            if not file.filename:
-                continue
-            
-            temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4()}_{file.filename}")
-            
-            with open(temp_path, "wb") as f:
-                content = await file.read()
-                f.write(content)
-
-            file_hash = calculate_hash(temp_path)
-            file_size = os.path.getsize(temp_path)
-
-            db = SessionLocal()
-            try:
-                existing_user_file = db.query(UserFile).filter(
-                    UserFile.filehash == file_hash,
-                    UserFile.username == username,
-                    UserFile.is_reference == 0
-                ).first()
-                
-                if not existing_user_file:
-                    new_original_size += file_size
-            finally:
-                db.close()
-
-            temp_files.append((temp_path, file.filename, file_hash, file_size))
-
-        if current_used + new_original_size > USER_QUOTA_BYTES:
+        # Upserting the stats row first takes SQLite's write lock, so the lookup and the quota
+        # charge below cannot interleave with an upload running in another worker
+        add_usage(db, username)
+        # One lookup for every hash in the batch; each new content counts against the quota once
+        already_stored = {h for (h,) in db.query(UserFile.filehash).filter(
+            UserFile.username == username,
+            UserFile.is_reference == 0,
+            UserFile.filehash.in_({file_hash for _, _, file_hash, _, _ in temp_files})
+        )}
+        new_original_size = 0
+        for _, _, file_hash, file_size, _ in temp_files:
+            if file_hash not in already_stored:
+                already_stored.add(file_hash)
+                new_original_size += file_size
+
+        if not charge_quota(db, username, new_original_size):
+            db.rollback()
             for temp_path, *_ in temp_files:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+                discard_file(temp_path)
             return JSONResponse({"results": [], "error": "Storage quota exceeded (10MB limit)"}, status_code=400)
 
-        results = []
-        db = SessionLocal()
-        try:
-            for temp_path, filename, file_hash, file_size in temp_files:
-                existing_user_file = db.query(UserFile).filter(
-                    UserFile.filehash == file_hash,
-                    UserFile.username == username,
-                    UserFile.is_reference == 0
-                ).first()
-                
-                if existing_user_file:
-                    os.remove(temp_path)
-                    filepath = existing_user_file.filepath
-                    message = "Duplicate (you already uploaded this file)"
-                    is_ref = 1
-                else:
-                    final_path = os.path.join(UPLOAD_FOLDER, f"{username}_{file_hash}")
-                    os.rename(temp_path, final_path)
-                    filepath = final_path
-                    message = "Uploaded successfully"
-                    is_ref = 0
+        for temp_path, filename, file_hash, file_size, data in temp_files:
+            # Claim the original slot atomically; the partial unique index turns a duplicate into a no-op
+            inserted = db.execute(
+                sqlite_insert(UserFile).values(
+                    filename=filename,
+                    filehash=file_hash,
+                    username=username,
+                    is_reference=0,
+                    size=file_size,
+                    folder=folder,
+                    is_public=0,
+                    download_count=0
+                ).on_conflict_do_nothing().returning(UserFile.id)
+            ).first()
 
+            if inserted:
+                file_id = inserted.id
+                message = "Uploaded successfully"
+            else:
                 entry = UserFile(
                     filename=filename,
-                    filepath=filepath,
                     filehash=file_hash,
                     username=username,
-                    is_reference=is_ref,
+                    is_reference=1,
                     size=file_size,
                     folder=folder,
                     is_public=0,
                     download_count=0
                 )
                 db.add(entry)
-                db.commit()
-                results.append({"filename": filename, "message": message})
-        finally:
-            db.close()
-            
-        return JSONResponse({"results": results})
+                db.flush()
+                file_id = entry.id
+                saved_added += file_size
+                message = "Duplicate (you already uploaded this file)"
+
+            stored_paths.extend(link_upload(file_id, file_hash, temp_path, data))
+            # Uploads that stayed in memory only have a temp file if they had to be published
+            discard_file(temp_path)
+            results.append({"filename": filename, "message": message})
+        add_usage(db, username, saved=saved_added)
+        db.commit()
+    except Exception:
+        db.rollback()
+        for stored_path in stored_paths:
+            discard_file(stored_path)
+        raise
+
+    return JSONResponse({"results": results})
+
+@app.post("/upload")
+async def upload(request: Request, background_tasks: BackgroundTasks, folder: str = Form("/"), files: list[UploadFile] = File(...), db: Session = Depends(get_db)):
+    username = request.session.get("username")
+    if not username:
+        return JSONResponse({"results": [], "error": "Session expired. Please login again."}, status_code=401)
+
+    if not files or all(not f.filename for f in files):
+        return JSONResponse({"results": [], "error": "No files selected"}, status_code=400)
+
+    now = time.monotonic()
+    # Entries are in recency order; anything older than the window can no longer throttle
+    while last_upload_time and now - next(iter(last_upload_time.values())) >= UPLOAD_RATE_LIMIT_SECONDS:
+        last_upload_time.popitem(last=False)
+    if username in last_upload_time:
+        return JSONResponse({"results": [], "error": "Too many uploads! Wait a second."}, status_code=429)
+    last_upload_time[username] = now
+    if len(last_upload_time) > RATE_LIMIT_MAX_USERS:
+        last_upload_time.popitem(last=False)
+
+    folder = normalize_folder_path(folder)
+
+    named_files = [f for f in files if f.filename]
+    digest = request.headers.get(CONTENT_HASH_HEADER, "").lower()
+    claimed_hash = HASH_PREFIX + digest if HEX_DIGEST_RE.fullmatch(digest) else None
+    pending = []
+
+    try:
+        # Fast path: a client-supplied digest that matches one of the user's originals
+        # becomes a reference row without writing or hashing the body again
+        if len(named_files) == 1 and claimed_hash:
+            results = await run_in_threadpool(
+                record_claimed_duplicate, db, username, folder, named_files[0].filename, claimed_hash
+            )
+            if results:
+                return JSONResponse({"results": results})
+
+        for file in named_files:
+            temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{secrets.token_hex(8)}_{file.filename}")
+            pending.append((file, temp_path))
+
+        loop = asyncio.get_running_loop()
+        digests = await asyncio.gather(*(
+            loop.run_in_executor(app.state.hash_executor, store_upload, file.file, temp_path)
+            for file, temp_path in pending
+        ), return_exceptions=True)
+        # Wait for every writer before failing so cleanup doesn't race a running thread
+        for digest in digests:
+            if isinstance(digest, Exception):
+                raise digest
+
+        temp_files = [
+            (temp_path, file.filename, file_hash, file_size, data)
+            for (file, temp_path), (file_hash, file_size, data) in zip(pending, digests)
+        ]
+        # Database work is synchronous; keep it off the event loop
+        return await run_in_threadpool(save_uploads, db, username, folder, temp_files)
         
     except Exception as e:
-        for temp_path, *_ in temp_files:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        for _, temp_path in pending:
+            background_tasks.add_task(discard_file, temp_path)
         return JSONResponse({"results": [], "error": f"Upload failed: {str(e)}"}, status_code=500)
 
 @app.get("/download/{file_id}")
-async def download(file_id: int, request: Request):
+def download(file_id: int, request: Request, db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return RedirectResponse("/")
     
-    db = SessionLocal()
-    try:
-        file = db.query(UserFile).filter(UserFile.id == file_id).first()
-        if not file:
-            raise HTTPException(404, detail="File not found")
-            
-        if file.username != username:
-            shared = db.query(SharedFile).filter(
-                SharedFile.file_id == file_id,
-                SharedFile.shared_with == username
-            ).first()
-            if not shared:
-                raise HTTPException(403, detail="Access denied")
-                
-        if not os.path.exists(file.filepath):
-            raise HTTPException(404, detail="File not available")
+    file = db.query(UserFile).filter(UserFile.id == file_id).first()
+    if not file:
+        raise HTTPException(404, detail="File not found")
+        
+    if file.username != username:
+        shared = db.query(SharedFile).filter(
+            SharedFile.file_id == file_id,
+            SharedFile.shared_with == username
+        ).first()
+        if not shared:
+            raise HTTPException(403, detail="Access denied")
             
-        return FileResponse(file.filepath, filename=file.filename)
-    finally:
-        db.close()
+    # One stat both checks the blob exists and hands Starlette its headers
+    filepath = blob_path(file.id, file.filehash)
+    try:
+        stat_result = os.stat(filepath)
+    except FileNotFoundError:
+        raise HTTPException(404, detail="File not available")
+        
+    return DownloadResponse(filepath, filename=file.filename, stat_result=stat_result)
 
 @app.get("/public/{token}")
-async def public_download(token: str):
-    db = SessionLocal()
+def public_download(token: str, db: Session = Depends(get_db)):
+    # Bump the counter in SQL and read back what we need in the same statement
+    file = db.execute(
+        update(UserFile)
+        .where(UserFile.share_token == token, UserFile.is_public == 1)
+        .values(download_count=UserFile.download_count + 1)
+        .returning(UserFile.id, UserFile.filehash, UserFile.filename)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if not file:
+        raise HTTPException(status_code=404, detail="Invalid or expired link")
+    filepath = blob_path(file.id, file.filehash)
     try:
-        file = db.query(UserFile).filter(UserFile.share_token == token, UserFile.is_public == 1).first()
-        if not file:
-            raise HTTPException(status_code=404, detail="Invalid or expired link")
-        if not os.path.exists(file.filepath):
-            raise HTTPException(status_code=404, detail="File not available")
-        
-        file.download_count += 1
-        db.commit()
-        
-        return FileResponse(
-            path=file.filepath,
-            filename=file.filename,
-            media_type="application/octet-stream"
-        )
-    finally:
-        db.close()
+        stat_result = os.stat(filepath)
+    except FileNotFoundError:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="File not available")
+    db.commit()
+    
+    return DownloadResponse(
+        path=filepath,
+        filename=file.filename,
+        media_type="application/octet-stream",
+        stat_result=stat_result
+    )
 
 @app.post("/toggle_share")
-async def toggle_share(request: Request, file_id: int = Form(...)):
+def toggle_share(request: Request, file_id: int = Form(...), db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return RedirectResponse("/")
     
-    db = SessionLocal()
-    try:
-        file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
-        if not file:
-            raise HTTPException(404)
-        file.is_public = 1 - file.is_public
-        file.share_token = str(uuid.uuid4()) if file.is_public else None
-        db.commit()
-    finally:
-        db.close()
+    file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
+    if not file:
+        raise HTTPException(404)
+    file.is_public = 1 - file.is_public
+    file.share_token = secrets.token_urlsafe(16) if file.is_public else None
+    db.commit()
     
     return RedirectResponse("/dashboard#my-files", status_code=303)
 
 @app.post("/share_with_user")
-async def share_with_user(request: Request, file_id: int = Form(...), target_username: str = Form(...)):
+def share_with_user(request: Request, file_id: int = Form(...), target_username: str = Form(...), db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return RedirectResponse("/")
     
-    db = SessionLocal()
-    try:
-        file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
-        if not file:
-            return RedirectResponse("/dashboard#my-files")
-        
-        if not db.query(User).filter(User.username == target_username).first():
-            return RedirectResponse("/dashboard#my-files")
-        
-        if target_username == username:
-            return RedirectResponse("/dashboard#my-files")
-        
-        if db.query(SharedFile).filter(
-            SharedFile.file_id == file_id,
-            SharedFile.shared_with == target_username
-        ).first():
-            return RedirectResponse("/dashboard#my-files")
-        
-        db.add(SharedFile(
-            file_id=file_id,
-            shared_with=target_username,
-            shared_by=username
-        ))
-        db.commit()
-    finally:
-        db.close()
+    file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
+    if not file:
+        return RedirectResponse("/dashboard#my-files")
+    
+    if not db.query(User).filter(User.username == target_username).first():
+        return RedirectResponse("/dashboard#my-files")
+    
+    if target_username == username:
+        return RedirectResponse("/dashboard#my-files")
+    
+    if db.query(SharedFile).filter(
+        SharedFile.file_id == file_id,
+        SharedFile.shared_with == target_username
+    ).first():
+        return RedirectResponse("/dashboard#my-files")
+    
+    db.add(SharedFile(
+        file_id=file_id,
+        shared_with=target_username,
+        shared_by=username
+    ))
+    db.commit()
     
     return RedirectResponse("/dashboard#my-files", status_code=303)
 
 @app.post("/create_folder")
-async def create_folder(request: Request, folder_name: str = Form(...)):
+def create_folder(request: Request, folder_name: str = Form(...), db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return RedirectResponse("/")
@@ -423,97 +810,84 @@ async def create_folder(request: Request, folder_name: str = Form(...)):
     if full_path == "/":
         return RedirectResponse("/dashboard#my-files", status_code=303)
     
-    db = SessionLocal()
-    try:
-        existing = db.query(UserFile).filter(
-            UserFile.username == username,
-            UserFile.folder == full_path,
-            UserFile.filename.like(".folder_marker_%")
-        ).first()
-        
-        if existing:
-            return RedirectResponse("/dashboard#my-files", status_code=303)
-        
-        folder_display_name = full_path.strip("/").split("/")[-1]
-        db.add(UserFile(
-            filename=f".folder_marker_{folder_display_name}",
-            filepath="",
-            filehash="folder_marker",
-            username=username,
-            is_reference=0,
-            size=0,
-            folder=full_path,
-            is_public=0,
-            download_count=0
-        ))
-        db.commit()
-    finally:
-        db.close()
+    existing = db.query(UserFile).filter(
+        UserFile.username == username,
+        UserFile.folder == full_path,
+        UserFile.filename.like(".folder_marker_%")
+    ).first()
+    
+    if existing:
+        return RedirectResponse("/dashboard#my-files", status_code=303)
+    
+    folder_display_name = full_path.strip("/").split("/")[-1]
+    db.add(UserFile(
+        filename=f".folder_marker_{folder_display_name}",
+        filehash="folder_marker",
+        username=username,
+        is_reference=0,
+        size=0,
+        folder=full_path,
+        is_public=0,
+        download_count=0
+    ))
+    db.commit()
     
     return RedirectResponse("/dashboard#my-files", status_code=303)
 
 @app.post("/delete")
-async def delete(request: Request, file_id: int = Form(...)):
+def delete(request: Request, background_tasks: BackgroundTasks, file_id: int = Form(...), db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return RedirectResponse("/")
     
-    db = SessionLocal()
-    try:
-        file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
-        if not file:
-            raise HTTPException(404)
-        
-        user_ref_count = db.query(UserFile).filter(
-            UserFile.filehash == file.filehash,
-            UserFile.username == username
-        ).count()
-        
-        db.delete(file)
-        db.commit()
-        
-        if user_ref_count == 1 and file.filepath and os.path.exists(file.filepath):
-            os.remove(file.filepath)
-    finally:
-        db.close()
+    # Ownership check and delete in one statement; RETURNING hands back what release_blob needs
+    file = db.execute(
+        sql_delete(UserFile)
+        .where(UserFile.id == file_id, UserFile.username == username)
+        .returning(UserFile.filehash, UserFile.is_reference, UserFile.size)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if not file:
+        raise HTTPException(404)
+    if file.is_reference:
+        add_usage(db, username, saved=-file.size)
+    else:
+        add_usage(db, username, actual=-file.size)
+    db.commit()
+    
+    # Unlinking happens after the redirect is sent
+    background_tasks.add_task(release_blob, file_id, file.filehash)
     
     return RedirectResponse("/dashboard#my-files", status_code=303)
 
 @app.post("/bulk_delete")
-async def bulk_delete(request: Request):
+def bulk_delete(request: Request, background_tasks: BackgroundTasks, file_ids: list[int] = Body([], embed=True), db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return JSONResponse({"error": "Not authenticated"}, status_code=401)
     
-    data = await request.json()
-    file_ids = data.get("file_ids", [])
-    
     if not file_ids:
         return JSONResponse({"error": "No files selected"}, status_code=400)
     
-    db = SessionLocal()
     try:
-        deleted_count = 0
-        for file_id in file_ids:
-            file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
-            if file:
-                user_ref_count = db.query(UserFile).filter(
-                    UserFile.filehash == file.filehash,
-                    UserFile.username == username
-                ).count()
-                
-                db.delete(file)
-                deleted_count += 1
-                
-                if user_ref_count == 1 and file.filepath and os.path.exists(file.filepath):
-                    os.remove(file.filepath)
-        
+        deleted = db.execute(
+            sql_delete(UserFile)
+            .where(UserFile.id.in_(file_ids), UserFile.username == username)
+            .returning(UserFile.id, UserFile.filehash, UserFile.is_reference, UserFile.size)
+            .execution_options(synchronize_session=False)
+        ).all()
+        add_usage(
+            db, username,
+            actual=-sum(row.size for row in deleted if not row.is_reference),
+            saved=-sum(row.size for row in deleted if row.is_reference),
+        )
         db.commit()
+        for deleted_id, filehash, *_ in deleted:
+            background_tasks.add_task(release_blob, deleted_id, filehash)
+        deleted_count = len(deleted)
         return JSONResponse({"success": True, "deleted_count": deleted_count})
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
-    finally:
-        db.close()
 
 @app.get("/logout")
 async def logout_get(request: Request):
@@ -526,78 +900,59 @@ async def logout_post(request: Request):
     return JSONResponse({"status": "logged out"})
 
 @app.get("/api/file/duplicate-locations/{file_id}")
-async def get_duplicate_locations(file_id: int, request: Request):
+def get_duplicate_locations(file_id: int, request: Request, db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return JSONResponse({"error": "Not authenticated"}, status_code=401)
     
-    db = SessionLocal()
-    try:
-        file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
-        if not file:
-            return JSONResponse({"error": "File not found"}, status_code=404)
-        
-        duplicates = db.query(UserFile).filter(
-            UserFile.filehash == file.filehash,
-            UserFile.username == username
-        ).all()
-        
-        locations = []
-        for dup in duplicates:
-            locations.append({
-                "id": dup.id,
-                "filename": dup.filename,
-                "folder": dup.folder,
-                "upload_date": dup.upload_date.strftime('%b %d, %Y %H:%M'),
-                "is_current": dup.id == file_id
-            })
-        
-        return JSONResponse({"locations": locations})
-    finally:
-        db.close()
+    file = db.query(UserFile).filter(UserFile.id == file_id, UserFile.username == username).first()
+    if not file:
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    
+    duplicates = db.query(UserFile).filter(
+        UserFile.filehash == file.filehash,
+        UserFile.username == username
+    ).all()
+    
+    locations = []
+    for dup in duplicates:
+        locations.append({
+            "id": dup.id,
+            "filename": dup.filename,
+            "folder": dup.folder,
+            "upload_date": dup.upload_date.strftime('%b %d, %Y %H:%M'),
+            "is_current": dup.id == file_id
+        })
+    
+    return JSONResponse({"locations": locations})
 
 @app.get("/api/file/preview/{file_id}")
-async def preview_file(file_id: int, request: Request):
+def preview_file(file_id: int, request: Request, db: Session = Depends(get_db)):
     username = request.session.get("username")
     if not username:
         return JSONResponse({"error": "Not authenticated"}, status_code=401)
 
-    db = SessionLocal()
-    try:
-        file = db.query(UserFile).filter(UserFile.id == file_id).first()
+    file = db.query(UserFile).filter(UserFile.id == file_id).first()
 
-        if not file:
-            return JSONResponse({"error": "File not found"}, status_code=404)
+    if not file:
+        return JSONResponse({"error": "File not found"}, status_code=404)
 
-        if file.username != username:
-            shared = db.query(SharedFile).filter(
-                SharedFile.file_id == file_id,
-                SharedFile.shared_with == username
-            ).first()
-            if not shared:
-                return JSONResponse({"error": "Access denied"}, status_code=403)
-
-        file_ext = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
-        file_type = 'unknown'
-
-        if file_ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg']:
-            file_type = 'image'
-        elif file_ext == 'pdf':
-            file_type = 'pdf'
-        elif file_ext in ['txt', 'md', 'json', 'xml', 'csv', 'log']:
-            file_type = 'text'
-        elif file_ext in ['mp4', 'webm', 'ogg', 'mov']:
-            file_type = 'video'
-        elif file_ext in ['mp3', 'wav', 'ogg', 'flac']:
-            file_type = 'audio'
-
-        return JSONResponse({
-            "id": file.id,
-            "filename": file.filename,
-            "size": file.size,
-            "type": file_type,
-            "extension": file_ext,
-            "download_url": f"/download/{file.id}"
-        })
-    finally:
-        db.close()
+    if file.username != username:
+        shared = db.query(SharedFile).filter(
+            SharedFile.file_id == file_id,
+            SharedFile.shared_with == username
+        ).first()
+        if not shared:
+            return JSONResponse({"error": "Access denied"}, status_code=403)
+
+    file_ext = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
+    file_type = PREVIEW_TYPES.get(file_ext, 'unknown')
+
+    return JSONResponse({
+        "id": file.id,
+        "filename": file.filename,
+        "size": file.size,
+        "type": file_type,
+        "extension": file_ext,
+        "download_url": f"/download/{file.id}"
+    })
@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-uvicorn main:app --host 0.0.0.0 --port 10000
+uvicorn main:app --host 0.0.0.0 --port 10000 --workers ${WEB_CONCURRENCY:-$(nproc)} --loop uvloop --http httptools --proxy-headers